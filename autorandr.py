@@ -26,6 +26,7 @@ from __future__ import print_function
 
 import binascii
 import copy
+import functools
 import getopt
 import hashlib
 import math
@@ -34,22 +35,15 @@ import posix
 import pwd
 import re
 import shlex
+import stat
 import subprocess
 import sys
-import shutil
 import time
 import glob
 
-from collections import OrderedDict
-from functools import reduce
+from collections import deque
 from itertools import chain
 
-
-if sys.version_info.major == 2:
-    import ConfigParser as configparser
-else:
-    import configparser
-
 __version__ = "1.15"
 
 try:
@@ -67,6 +61,7 @@ virtual_profiles = [
     ("horizontal-reverse", "Stack all connected outputs horizontally at their largest resolution in reverse order", None),
     ("vertical-reverse", "Stack all connected outputs vertically at their largest resolution in reverse order", None),
 ]
+_VIRTUAL_NAMES = frozenset(x[0] for x in virtual_profiles)
 
 properties = [
     "Colorspace",
@@ -82,6 +77,10 @@ properties = [
     "scaling mode",
 ]
 
+# Maps the option-name form of each property (as used in x-prop-* options and
+# as regex group names) to the name xrandr knows it by
+_PROP_SLUG_TO_XRANDR = {re.sub(r"\W+", "_", p.lower()): p for p in properties}
+
 help_text = """
 Usage: autorandr [options]
 
@@ -117,42 +116,83 @@ Usage: autorandr [options]
  The following virtual configurations are available:
 """.strip()
 
+_ORD_SUFFIX = ("st", "nd", "rd", "th")
+_SHORT_OPTS = "s:r:l:d:cfh"
+_LONG_OPTS = (
+    "batch",
+    "dry-run",
+    "change",
+    "cycle",
+    "default=",
+    "save=",
+    "remove=",
+    "load=",
+    "force",
+    "fingerprint",
+    "config",
+    "debug",
+    "skip-options=",
+    "help",
+    "list",
+    "current",
+    "detected",
+    "version",
+    "match-edid",
+    "ignore-lid",
+)
+
 
 class Version(object):
     def __init__(self, version):
         self._version = version
         self._version_parts = re.split("([0-9]+)", version)
+        # Numeric and non-numeric parts alternate, so keys of two versions
+        # always compare like with like
+        self._key = tuple(int(part) if part.isnumeric() else part for part in self._version_parts)
 
     def __eq__(self, other):
-        return self._version_parts == other._version_parts
+        return self._key == other._key
 
     def __lt__(self, other):
-        for my, theirs in zip(self._version_parts, other._version_parts):
-            if my.isnumeric() and theirs.isnumeric():
-                my = int(my)
-                theirs = int(theirs)
-            if my < theirs:
-                return True
-        return len(theirs) > len(my)
+        return self._key < other._key
 
     def __ge__(self, other):
-        return not (self < other)
+        return self._key >= other._key
 
     def __ne__(self, other):
-        return not (self == other)
+        return self._key != other._key
 
     def __le__(self, other):
-        return (self < other) or (self == other)
+        return self._key <= other._key
 
     def __gt__(self, other):
-        return self >= other and not (self == other)
+        return self._key > other._key
 
-def is_closed_lid(output):
-    if not re.match(r'(eDP(-?[0-9]\+)*|LVDS(-?[0-9]\+)*)', output):
-        return False
+
+_XRANDR_V12 = Version("1.2")
+_XRANDR_V13 = Version("1.3")
+
+
+_FUZZY_OUTPUT_RE = re.compile("(card[0-9]+|-)")
+_MODE_RE = re.compile("[0-9]{3,}x[0-9]{3,}")
+_PANNING_RE = re.compile(r"(?P<w>[0-9]+)x(?P<h>[0-9]+)(?:\+(?P<x>[0-9]+))?(?:\+(?P<y>[0-9]+))?.*")
+_LID_OUTPUT_RE = re.compile(r'(eDP(-?[0-9]\+)*|LVDS(-?[0-9]\+)*)')
+
+
+@functools.lru_cache(maxsize=1)
+def _lid_state_path():
+    "Return the path of the ACPI lid state file, or None unless there is exactly one lid"
     lids = glob.glob("/proc/acpi/button/lid/*/state")
     if len(lids) == 1:
-        state_file = lids[0]
+        return lids[0]
+    return None
+
+
+def is_closed_lid(output):
+    if not _LID_OUTPUT_RE.match(output):
+        return False
+    state_file = _lid_state_path()
+    if state_file:
         with open(state_file) as f:
             content = f.read()
             return "close" in content
@@ -203,8 +243,8 @@ class XrandrOutput(object):
 
     XRANDR_PROPERTIES_REGEXP = "|".join(
         [r"{}:\s*(?P<{}>[\S ]*\S+)"
-         .format(re.sub(r"\s", r"\\\g<0>", p), re.sub(r"\W+", "_", p.lower()))
-            for p in properties])
+         .format(re.sub(r"\s", r"\\\g<0>", p), slug)
+            for slug, p in _PROP_SLUG_TO_XRANDR.items()])
 
     # This regular expression is used to parse an output in `xrandr --verbose'
     XRANDR_OUTPUT_REGEXP = r"""(?x)
@@ -245,11 +285,9 @@ class XrandrOutput(object):
         )*)
     """
 
-    XRANDR_OUTPUT_MODES_REGEXP = r"""(?x)
-        (?P<name>\S+).+?(?P<preferred>\+preferred)?\s+
-         h:\s+width\s+(?P<width>[0-9]+).+\s+
-         v:\s+height\s+(?P<height>[0-9]+).+clock\s+(?P<rate>[0-9\.]+)Hz\s* |
-    """
+    # These are matched against the two timing lines of a mode in the `modes' group of the above
+    XRANDR_MODE_H_REGEXP = re.compile(r"\s*h:\s+width\s+(?P<width>[0-9]+)")
+    XRANDR_MODE_V_REGEXP = re.compile(r"\s*v:\s+height\s+(?P<height>[0-9]+).+clock\s+(?P<rate>[0-9\.]+)Hz")
 
     XRANDR_13_DEFAULTS = {
         "transform": "1,0,0,0,1,0,0,0,1",
@@ -266,27 +304,43 @@ class XrandrOutput(object):
 
     EDID_UNAVAILABLE = "--CONNECTED-BUT-EDID-UNAVAILABLE-"
 
+    _xrandr_version_defaults = None
+
     def __repr__(self):
         return "<%s%s %s>" % (self.output, self.fingerprint, " ".join(self.option_vector))
 
     @property
     def short_edid(self):
-        return ("%s..%s" % (self.edid[:5], self.edid[-5:])) if self.edid else ""
+        return self._short_edid
 
     @property
     def options_with_defaults(self):
         "Return the options dictionary, augmented with the default values that weren't set"
+        # Cached, since this is needed for every option_vector
+        if self._options_with_defaults is None:
+            self._options_with_defaults = self._build_options_with_defaults()
+        return self._options_with_defaults
+
+    def _build_options_with_defaults(self):
         if "off" in self.options:
             return self.options
-        options = {}
-        if xrandr_version() >= Version("1.3"):
-            options.update(self.XRANDR_13_DEFAULTS)
-        if xrandr_version() >= Version("1.2"):
-            options.update(self.XRANDR_12_DEFAULTS)
+        options = dict(self.xrandr_version_defaults())
         options.update(self.options)
         if "set" in self.ignored_options:
             options = {a: b for a, b in options.items() if not a.startswith("x-prop")}
-        return {a: b for a, b in options.items() if a not in self.ignored_options}
+        return {a: b for a, b in sorted(options.items()) if a not in self.ignored_options}
+
+    @classmethod
+    def xrandr_version_defaults(cls):
+        "Return the default values of the options supported by the installed XRandR version"
+        if cls._xrandr_version_defaults is None:
+            defaults = {}
+            if xrandr_version() >= _XRANDR_V13:
+                defaults.update(cls.XRANDR_13_DEFAULTS)
+            if xrandr_version() >= _XRANDR_V12:
+                defaults.update(cls.XRANDR_12_DEFAULTS)
+            cls._xrandr_version_defaults = defaults
+        return cls._xrandr_version_defaults
 
     @property
     def filtered_options(self):
@@ -300,23 +354,19 @@ class XrandrOutput(object):
     def option_vector(self):
         "Return the command line parameters for XRandR for this instance"
         args = ["--output", self.output]
-        for option, arg in sorted(self.options_with_defaults.items()):
+        for option, arg in self.options_with_defaults.items():
             if option.startswith("x-prop-"):
-                prop_found = False
-                for prop, xrandr_prop in [(re.sub(r"\W+", "_", p.lower()), p) for p in properties]:
-                    if prop == option[7:]:
-                        args.append("--set")
-                        args.append(xrandr_prop)
-                        prop_found = True
-                        break
-                if not prop_found:
+                xrandr_prop = _PROP_SLUG_TO_XRANDR.get(option[7:])
+                if xrandr_prop is None:
                     print("Warning: Unknown property `%s' in config file. Skipping." % option[7:], file=sys.stderr)
                     continue
+                args.append("--set")
+                args.append(xrandr_prop)
             elif option.startswith("x-"):
                 print("Warning: Unknown option `%s' in config file. Skipping." % option, file=sys.stderr)
                 continue
             else:
-                args.append("--%s" % option)
+                args.append("--" + option)
             if arg:
                 args.append(arg)
         return args
@@ -324,34 +374,36 @@ class XrandrOutput(object):
     @property
     def option_string(self):
         "Return the command line parameters in the configuration file format"
-        options = ["output %s" % self.output]
-        for option, arg in sorted(self.filtered_options.items()):
-            if arg:
-                options.append("%s %s" % (option, arg))
-            else:
-                options.append(option)
-        return "\n".join(options)
+        if self._option_lines is None:
+            # The output name is left out, renaming an output must not invalidate this
+            self._option_lines = "".join("\n" + (option + " " + arg if arg else option)
+                                         for option, arg in self.filtered_options.items())
+        return "output " + self.output + self._option_lines
 
     @property
     def sort_key(self):
         "Return a key to sort the outputs for xrandr invocation"
         if not self.edid:
             return -2
-        if "off" in self.options:
-            return -1
-        if "pos" in self.options:
-            x, y = map(float, self.options["pos"].split("x"))
-        else:
-            x, y = 0, 0
-        return x + 10000 * y
+        if self._position_sort_key is None:
+            if "off" in self.options:
+                self._position_sort_key = -1
+            elif "pos" in self.options:
+                x, y = map(float, self.options["pos"].split("x"))
+                self._position_sort_key = x + 10000 * y
+            else:
+                self._position_sort_key = 0
+        return self._position_sort_key
 
     def __init__(self, output, edid, options):
         "Instantiate using output name, edid and a dictionary of XRandR command line parameters"
         self.output = output
         self.edid = edid
         self.options = options
-        self.ignored_options = []
+        self.ignored_options = frozenset()
+        self.reset_cached_options()
         self.parse_serial_from_edid()
+        self.update_fingerprint()
         self.remove_default_option_values()
 
     def parse_serial_from_edid(self):
@@ -378,21 +430,47 @@ class XrandrOutput(object):
                     if timing_type == 0xFF:
                         buffer = timing_bytes[5:]
                         buffer = buffer.partition(b'\x0a')[0]
-                        serial_text = buffer.decode('cp437')
+                        # cp437 agrees with ASCII on the lower half, and serials rarely leave it
+                        try:
+                            serial_text = buffer.decode('ascii')
+                        except UnicodeDecodeError:
+                            serial_text = buffer.decode('cp437')
             self.serial = serial_text if serial_text else "0x{:x}".format(serial_no) if serial_no != 0 else None
 
+    def update_fingerprint(self):
+        "Compute the short EDID and fingerprint once; must be called again if edid is changed"
+        self._short_edid = ("%s..%s" % (self.edid[:5], self.edid[-5:])) if self.edid else ""
+        self._fingerprint = str(self.serial) if self.serial else self._short_edid
+
+    def reset_cached_options(self):
+        "Forget the values derived from the options; required after modifying them"
+        self._options_with_defaults = None
+        self._position_sort_key = None
+        self._option_lines = None
+
+    def copy_with_options(self, options):
+        "Return a shallow copy of this output that uses the given options"
+        output = copy.copy(self)
+        output.options = options
+        output.reset_cached_options()
+        return output
+
     def set_ignored_options(self, options):
         "Set a list of xrandr options that are never used (neither when comparing configurations nor when applying them)"
-        self.ignored_options = list(options)
+        # Passing a frozenset shares it between all outputs instead of copying it
+        self.ignored_options = frozenset(options)
+        self.reset_cached_options()
 
     def remove_default_option_values(self):
         "Remove values from the options dictionary that are superfluous"
+        self.reset_cached_options()
         if "off" in self.options and len(self.options.keys()) > 1:
             self.options = {"off": None}
             return
-        for option, default_value in self.XRANDR_DEFAULTS.items():
-            if option in self.options and self.options[option] == default_value:
-                del self.options[option]
+        # Keep the options sorted by name, so that option_string and option_vector
+        # can render them in a stable order without sorting on every call
+        self.options = {option: value for option, value in sorted(self.options.items())
+                        if option not in self.XRANDR_DEFAULTS or self.XRANDR_DEFAULTS[option] != value}
 
     @classmethod
     def from_xrandr_output(cls, xrandr_output):
@@ -421,10 +499,7 @@ class XrandrOutput(object):
 
         modes = []
         if match["modes"]:
-            modes = []
-            for mode_match in re.finditer(XrandrOutput.XRANDR_OUTPUT_MODES_REGEXP, match["modes"]):
-                if mode_match.group("name"):
-                    modes.append(mode_match.groupdict())
+            modes = XrandrOutput.parse_modes(match["modes"])
             if not modes:
                 raise AutorandrException("Parsing XRandR output failed, couldn't find any display modes", report_bug=True)
 
@@ -495,15 +570,43 @@ class XrandrOutput(object):
                 options["crtc"] = match["crtc"]
             if match["rate"]:
                 options["rate"] = match["rate"]
-            for prop in [re.sub(r"\W+", "_", p.lower()) for p in properties]:
+            for prop in _PROP_SLUG_TO_XRANDR:
                 if match[prop]:
                     options["x-prop-" + prop] = match[prop]
 
         return XrandrOutput(match["output"], edid, options), modes
 
     @classmethod
-    def from_config_file(cls, profile, edid_map, configuration):
-        "Instantiate an XrandrOutput from the contents of a configuration file"
+    def parse_modes(cls, modes_text):
+        """Parse the list of modes of an output in `xrandr --verbose'
+
+        The regular expression for the whole output ensures that each mode consists of a line with its name
+        and flags followed by a h: and a v: timing line.
+        """
+        modes = []
+        lines = [line for line in modes_text.split("\n") if line and not line.isspace()]
+        for index in range(0, len(lines) - 2, 3):
+            h_match = cls.XRANDR_MODE_H_REGEXP.match(lines[index + 1])
+            v_match = cls.XRANDR_MODE_V_REGEXP.match(lines[index + 2])
+            if not h_match or not v_match:
+                continue
+            name_line = lines[index].split()
+            modes.append({
+                "name": name_line[0],
+                "preferred": "+preferred" if name_line[-1] == "+preferred" else None,
+                "width": h_match.group("width"),
+                "height": v_match.group("height"),
+                "rate": v_match.group("rate"),
+            })
+        return modes
+
+    @classmethod
+    def from_config_file(cls, profile, edid_map, configuration, fuzzy_edid_map=None):
+        """Instantiate an XrandrOutput from the contents of a configuration file
+
+        fuzzy_edid_map is edid_map with the keys normalized by fuzzy_output_name. Pass it
+        when creating several outputs from the same setup file to compute it only once.
+        """
         options = {}
         for line in configuration.split("\n"):
             if line:
@@ -518,10 +621,11 @@ class XrandrOutput(object):
             edid = edid_map[options["output"]]
         else:
             # This fuzzy matching is for legacy autorandr that used sysfs output names
-            fuzzy_edid_map = [re.sub("(card[0-9]+|-)", "", x) for x in edid_map.keys()]
-            fuzzy_output = re.sub("(card[0-9]+|-)", "", options["output"])
+            if fuzzy_edid_map is None:
+                fuzzy_edid_map = fuzzy_edid_mapping(edid_map)
+            fuzzy_output = fuzzy_output_name(options["output"])
             if fuzzy_output in fuzzy_edid_map:
-                edid = edid_map[list(edid_map.keys())[fuzzy_edid_map.index(fuzzy_output)]]
+                edid = fuzzy_edid_map[fuzzy_output]
             elif "off" not in options:
                 raise AutorandrException("Profile `%s': Failed to find an EDID for output `%s' in setup file, required "
                                          "as `%s' is not off in config file." % (profile, options["output"], options["output"]))
@@ -532,7 +636,7 @@ class XrandrOutput(object):
 
     @property
     def fingerprint(self):
-        return str(self.serial) if self.serial else self.short_edid
+        return self._fingerprint
 
     def fingerprint_equals(self, other):
         if self.serial and other.serial:
@@ -571,19 +675,34 @@ class XrandrOutput(object):
         elif "off" in other.options and "off" not in self.options:
             diffs.append("The output is currently enabled, but inactive in the new configuration")
         else:
-            for name in set(chain.from_iterable((self.options.keys(), other.options.keys()))):
-                if name not in other.options:
-                    diffs.append("Option --%s %sis not present in the new configuration" %
-                                 (name, "(= `%s') " % self.options[name] if self.options[name] else ""))
-                elif name not in self.options:
+            for name in self.options.keys() | other.options.keys():
+                if name not in self.options:
                     diffs.append("Option --%s (`%s' in the new configuration) is not present currently" %
                                  (name, other.options[name]))
-                elif self.options[name] != other.options[name]:
-                    diffs.append("Option --%s %sis `%s' in the new configuration" %
-                                 (name, "(= `%s') " % self.options[name] if self.options[name] else "", other.options[name]))
+                    continue
+                value = self.options[name]
+                current_value = "(= `%s') " % value if value else ""
+                if name not in other.options:
+                    diffs.append("Option --%s %sis not present in the new configuration" % (name, current_value))
+                elif value != other.options[name]:
+                    diffs.append("Option --%s %sis `%s' in the new configuration" % (name, current_value, other.options[name]))
         return diffs
 
 
+def fuzzy_output_name(output):
+    "Normalize an output name for matching against legacy autorandr's sysfs output names"
+    return _FUZZY_OUTPUT_RE.sub("", output)
+
+
+def fuzzy_edid_mapping(edid_map):
+    "Return a copy of an output name -> edid map keyed by fuzzy_output_name"
+    fuzzy_edid_map = {}
+    for output, edid in edid_map.items():
+        # Like an exact match, the first output that normalizes to a name wins
+        fuzzy_edid_map.setdefault(fuzzy_output_name(output), edid)
+    return fuzzy_edid_map
+
+
 def xrandr_version():
     "Return the version of XRandR that this system uses"
     if getattr(xrandr_version, "version", False) is False:
@@ -632,8 +751,8 @@ def parse_xrandr_output(
     split_xrandr_output = re.split("(?m)^([^ ]+ (?:(?:dis)?connected|unknown connection).*)$", xrandr_output)
     if len(split_xrandr_output) < 2:
         raise AutorandrException("No output boundaries found", report_bug=True)
-    outputs = OrderedDict()
-    modes = OrderedDict()
+    outputs = {}
+    modes = {}
     for i in range(1, len(split_xrandr_output), 2):
         output_name = split_xrandr_output[i].split()[0]
         output, output_modes = XrandrOutput.from_xrandr_output("".join(split_xrandr_output[i:i + 2]))
@@ -642,62 +761,68 @@ def parse_xrandr_output(
             modes[output_name] = output_modes
 
     # consider a closed lid as disconnected if other outputs are connected
-    if not ignore_lid and sum(
-        o.edid != None
-        for o
-        in outputs.values()
-    ) > 1:
+    connected_count = 0
+    if not ignore_lid:
+        for output in outputs.values():
+            if output.edid is not None:
+                connected_count += 1
+                if connected_count > 1:
+                    break
+    if connected_count > 1:
         for output_name in outputs.keys():
             if is_closed_lid(output_name):
                 outputs[output_name].edid = None
+                outputs[output_name].update_fingerprint()
 
     return outputs, modes
 
 
-def load_profiles(profile_path):
-    "Load the stored profiles"
+def scan_profiles(profile_path):
+    "Load the stored profiles and the symlinks between them, in a single pass over the directory"
 
     profiles = {}
-    for profile in os.listdir(profile_path):
-        config_name = os.path.join(profile_path, profile, "config")
-        setup_name = os.path.join(profile_path, profile, "setup")
-        if not os.path.isfile(config_name) or not os.path.isfile(setup_name):
-            continue
-
-        edids = dict([x.split() for x in (y.strip() for y in open(setup_name).readlines()) if x and x[0] != "#"])
-
-        config = {}
-        buffer = []
-        for line in chain(open(config_name).readlines(), ["output"]):
-            if line[:6] == "output" and buffer:
-                config[buffer[0].strip().split()[-1]] = XrandrOutput.from_config_file(profile, edids, "".join(buffer))
-                buffer = [line]
-            else:
-                buffer.append(line)
-
-        for output_name in list(config.keys()):
-            if config[output_name].edid is None:
-                del config[output_name]
-
-        profiles[profile] = {
-            "config": config,
-            "path": os.path.join(profile_path, profile),
-            "config-mtime": os.stat(config_name).st_mtime,
-        }
+    symlinks = {}
+    with os.scandir(profile_path) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                symlinks[entry.name] = os.readlink(entry.path)
+            if not entry.is_dir():
+                continue
+            profile = entry.name
+            config_name = os.path.join(entry.path, "config")
+            setup_name = os.path.join(entry.path, "setup")
+            try:
+                # Also provides the mtime below
+                config_stat = os.stat(config_name)
+            except OSError:
+                continue
+            if not stat.S_ISREG(config_stat.st_mode) or not os.path.isfile(setup_name):
+                continue
 
-    return profiles
+            edids = dict([x.split() for x in (y.strip() for y in open(setup_name).readlines()) if x and x[0] != "#"])
+            fuzzy_edids = fuzzy_edid_mapping(edids)
 
+            config = {}
+            buffer = []
+            for line in chain(open(config_name).readlines(), ["output"]):
+                if line[:6] == "output" and buffer:
+                    output = XrandrOutput.from_config_file(profile, edids, "".join(buffer), fuzzy_edids)
+                    config[buffer[0].strip().split()[-1]] = output
+                    buffer = [line]
+                else:
+                    buffer.append(line)
 
-def get_symlinks(profile_path):
-    "Load all symlinks from a directory"
+            for output_name in list(config.keys()):
+                if config[output_name].edid is None:
+                    del config[output_name]
 
-    symlinks = {}
-    for link in os.listdir(profile_path):
-        file_name = os.path.join(profile_path, link)
-        if os.path.islink(file_name):
-            symlinks[link] = os.readlink(file_name)
+            profiles[profile] = {
+                "config": config,
+                "path": entry.path,
+                "config-mtime": config_stat.st_mtime,
+            }
 
-    return symlinks
+    return profiles, symlinks
 
 
 def match_asterisk(pattern, data):
@@ -709,63 +834,81 @@ def match_asterisk(pattern, data):
     """
     if "*" not in pattern:
         return 1 if pattern == data else 0
-    parts = pattern.split("*")
-    if len(parts) > 2:
-        raise ValueError("Only patterns with a single asterisk are supported, %s is invalid" % pattern)
-    if not data.startswith(parts[0]):
-        return 0
-    if not data.endswith(parts[1]):
+    prefix, suffix = split_asterisk_pattern(pattern)
+    if not data.startswith(prefix) or not data.endswith(suffix):
         return 0
     matched = len(pattern)
     total = len(data) + 1
     return matched * 1. / total
 
 
+@functools.lru_cache(maxsize=None)
+def split_asterisk_pattern(pattern):
+    "Split a match_asterisk pattern into the parts before and after the asterisk"
+    parts = pattern.split("*")
+    if len(parts) != 2:
+        raise ValueError("Only patterns with a single asterisk are supported, %s is invalid" % pattern)
+    return parts[0], parts[1]
+
+
 def update_profiles_edid(profiles, config):
     fp_map = {}
     for c in config:
         if config[c].fingerprint is not None:
             fp_map[config[c].fingerprint] = c
 
-    for p in profiles:
-        profile_config = profiles[p]["config"]
-
-        for fingerprint in fp_map:
-            for c in list(profile_config.keys()):
-                if profile_config[c].fingerprint != fingerprint or c == fp_map[fingerprint]:
-                    continue
-
-                print("%s: renaming display %s to %s" % (p, c, fp_map[fingerprint]), file=sys.stderr)
+    for p, profile in profiles.items():
+        profile_config = profile["config"]
+        renames = [(c, output) for c, output in profile_config.items()
+                   if output.fingerprint in fp_map and c != fp_map[output.fingerprint]]
+
+        for c, tmp_disp in renames:
+            fingerprint = tmp_disp.fingerprint
+            target = fp_map[fingerprint]
+            if profile_config.get(c) is not tmp_disp:
+                # Moved by an earlier rename, which keeps the output attribute up to date
+                c = tmp_disp.output
+            if c == target:
+                continue
+            if target in profile_config and profile_config[target].fingerprint == fingerprint:
+                # Two outputs with the same fingerprint, one of them already is in place
+                continue
 
-                tmp_disp = profile_config[c]
+            print("%s: renaming display %s to %s" % (p, c, target), file=sys.stderr)
 
-                if fp_map[fingerprint] in profile_config:
-                    # Swap the two entries
-                    profile_config[c] = profile_config[fp_map[fingerprint]]
-                    profile_config[c].output = c
-                else:
-                    # Object is reassigned to another key, drop this one
-                    del profile_config[c]
+            if target in profile_config:
+                # Swap the two entries
+                profile_config[c] = profile_config[target]
+                profile_config[c].output = c
+            else:
+                # Object is reassigned to another key, drop this one
+                del profile_config[c]
 
-                profile_config[fp_map[fingerprint]] = tmp_disp
-                profile_config[fp_map[fingerprint]].output = fp_map[fingerprint]
+            profile_config[target] = tmp_disp
+            profile_config[target].output = target
 
 
 def find_profiles(current_config, profiles):
     "Find profiles matching the currently connected outputs, sorting asterisk matches to the back"
     detected_profiles = []
+    # Profiles must configure all connected outputs. Fingerprints themselves cannot be compared
+    # as a set since fingerprint_equals also accepts legacy md5 and wildcard EDIDs, but the
+    # output names can, which quickly rules out most profiles.
+    connected_outputs = {name for name, output in current_config.items() if output.fingerprint}
     for profile_name, profile in profiles.items():
         config = profile["config"]
         matches = True
         if not config.items():
             continue
+        if not connected_outputs <= config.keys():
+            continue
         for name, output in config.items():
             if not output.fingerprint:
                 continue
             if name not in current_config or not output.fingerprint_equals(current_config[name]):
                 matches = False
                 break
-        if not matches or any((name not in config.keys() for name in current_config.keys() if current_config[name].fingerprint)):
+        if not matches:
             continue
         if matches:
             closeness = max(match_asterisk(output.edid, current_config[name].edid), match_asterisk(
@@ -798,16 +941,14 @@ def check_configuration_pre_save(configuration):
 def output_configuration(configuration, config):
     "Write a configuration file"
     outputs = sorted(configuration.keys(), key=lambda x: configuration[x].sort_key)
-    for output in outputs:
-        print(configuration[output].option_string, file=config)
+    config.write("".join(configuration[output].option_string + "\n" for output in outputs))
 
 
 def output_setup(configuration, setup):
     "Write a setup (fingerprint) file"
     outputs = sorted(configuration.keys())
-    for output in outputs:
-        if configuration[output].edid:
-            print(output, configuration[output].edid, file=setup)
+    setup.write("".join("%s %s\n" % (output, configuration[output].edid)
+                        for output in outputs if configuration[output].edid))
 
 
 def save_configuration(profile_path, profile_name, configuration, forced=False):
@@ -832,10 +973,17 @@ def update_mtime(filename):
     try:
         os.utime(filename, None)
         return True
-    except:
+    except OSError:
         return False
 
 
+def devnull_fd():
+    "Return a file descriptor for /dev/null, opened once and shared by all xrandr invocations"
+    if getattr(devnull_fd, "fd", None) is None:
+        devnull_fd.fd = os.open(os.devnull, os.O_WRONLY | os.O_CLOEXEC)
+    return devnull_fd.fd
+
+
 def call_and_retry(*args, **kwargs):
     """Wrapper around subprocess.call that retries failed calls.
 
@@ -849,11 +997,7 @@ def call_and_retry(*args, **kwargs):
         print()
         return 0
     else:
-        if hasattr(subprocess, "DEVNULL"):
-            kwargs["stdout"] = getattr(subprocess, "DEVNULL")
-        else:
-            kwargs["stdout"] = open(os.devnull, "w")
-        kwargs["stderr"] = kwargs["stdout"]
+        kwargs["stdout"] = kwargs["stderr"] = devnull_fd()
         retval = subprocess.call(*args, **kwargs)
         if retval != 0:
             time.sleep(1)
@@ -864,11 +1008,13 @@ def call_and_retry(*args, **kwargs):
 def get_fb_dimensions(configuration):
     width = 0
     height = 0
+    # Dimensions stay integral unless an output is transformed
+    any_transform = False
     for output in configuration.values():
         if "off" in output.options or not output.edid:
             continue
         # This won't work with all modes -- but it's a best effort.
-        match = re.search("[0-9]{3,}x[0-9]{3,}", output.options["mode"])
+        match = _MODE_RE.search(output.options["mode"])
         if not match:
             return None
         o_mode = match.group(0)
@@ -879,6 +1025,7 @@ def get_fb_dimensions(configuration):
             x = (a * o_width + b * o_height + c) / w
             y = (d * o_width + e * o_height + f) / w
             o_width, o_height = x, y
+            any_transform = True
         if "rotate" in output.options:
             if output.options["rotate"] in ("left", "right"):
                 o_width, o_height = o_height, o_width
@@ -887,14 +1034,16 @@ def get_fb_dimensions(configuration):
             o_width += o_left
             o_height += o_top
         if "panning" in output.options:
-            match = re.match(r"(?P<w>[0-9]+)x(?P<h>[0-9]+)(?:\+(?P<x>[0-9]+))?(?:\+(?P<y>[0-9]+))?.*", output.options["panning"])
+            match = _PANNING_RE.match(output.options["panning"])
             if match:
                 detail = match.groupdict(default="0")
                 o_width = int(detail.get("w")) + int(detail.get("x"))
                 o_height = int(detail.get("h")) + int(detail.get("y"))
         width = max(width, o_width)
         height = max(height, o_height)
-    return math.ceil(width), math.ceil(height)
+    if any_transform:
+        return math.ceil(width), math.ceil(height)
+    return width, height
 
 
 def apply_configuration(new_configuration, current_configuration, dry_run=False):
@@ -926,16 +1075,17 @@ def apply_configuration(new_configuration, current_configuration, dry_run=False)
     #   (See https://github.com/phillipberndt/autorandr/issues/72)
 
     fb_dimensions = get_fb_dimensions(new_configuration)
-    try:
+    if fb_dimensions:
         fb_args = ["--fb", "%dx%d" % fb_dimensions]
-    except:
+    else:
         # Failed to obtain frame-buffer size. Doesn't matter, xrandr will choose for the user.
         fb_args = []
 
     auxiliary_changes_pre = []
     disable_outputs = []
-    enable_outputs = []
+    enable_outputs = deque()
     remain_active_count = 0
+    has_xrandr_13 = xrandr_version() >= Version("1.3.0")
     for output in outputs:
         if not new_configuration[output].edid or "off" in new_configuration[output].options:
             disable_outputs.append(new_configuration[output].option_vector)
@@ -947,7 +1097,7 @@ def apply_configuration(new_configuration, current_configuration, dry_run=False)
                 remain_active_count += 1
 
             option_vector = new_configuration[output].option_vector
-            if xrandr_version() >= Version("1.3.0"):
+            if has_xrandr_13:
                 for option, off_value in (("transform", "none"), ("panning", "0x0")):
                     if option in current_configuration[output].options:
                         auxiliary_changes_pre.append(["--output", output, "--%s" % option, off_value])
@@ -962,13 +1112,13 @@ def apply_configuration(new_configuration, current_configuration, dry_run=False)
                 position = new_configuration[output].options.get("pos", "0x0")
                 if position == "0x0":
                     found_top_left_monitor = True
-                    enable_outputs.insert(0, option_vector)
+                    enable_outputs.appendleft(option_vector)
                 elif not found_left_monitor and position.startswith("0x"):
                     found_left_monitor = True
-                    enable_outputs.insert(0, option_vector)
+                    enable_outputs.appendleft(option_vector)
                 elif not found_top_monitor and position.endswith("x0"):
                     found_top_monitor = True
-                    enable_outputs.insert(0, option_vector)
+                    enable_outputs.appendleft(option_vector)
                 else:
                     enable_outputs.append(option_vector)
             else:
@@ -1009,12 +1159,17 @@ def apply_configuration(new_configuration, current_configuration, dry_run=False)
     if not found_top_left_monitor and len(disable_outputs) > 0:
         # If the call to 0x and x0 is split, inject one of them
         if found_top_monitor and found_left_monitor:
-            enable_outputs.insert(0, enable_outputs[0])
+            enable_outputs.appendleft(enable_outputs[0])
 
-    # Enable the remaining outputs in pairs of two operations
-    operations = disable_outputs + enable_outputs
+    # Enable the remaining outputs in pairs of two operations. Disabling is batched into the single
+    # call above; only what is left of it goes through here. Pairs are needed because some drivers
+    # fail to enable more than two screens at once (see PR #6), and pairing the remaining disable
+    # operations with enables keeps at least one screen active at any time (see PR #20).
+    operations = disable_outputs + list(enable_outputs)
     for index in range(0, len(operations), 2):
-        argv = base_argv + list(chain.from_iterable(operations[index:index + 2]))
+        argv = base_argv + operations[index]
+        if index + 1 < len(operations):
+            argv += operations[index + 1]
         if call_and_retry(argv, dry_run=dry_run) != 0:
             raise AutorandrException("Command failed: %s" % " ".join(map(shlex.quote, argv)))
 
@@ -1031,42 +1186,55 @@ def is_equal_configuration(source_configuration, target_configuration):
         Check if all outputs from target are already configured correctly in source and
         that no other outputs are active.
     """
-    for output in target_configuration.keys():
-        if "off" in target_configuration[output].options:
-            if (output in source_configuration and "off" not in source_configuration[output].options):
-                return False
-        else:
-            if (output not in source_configuration) or (source_configuration[output] != target_configuration[output]):
-                return False
-    for output in source_configuration.keys():
-        if "off" in source_configuration[output].options:
-            if output in target_configuration and "off" not in target_configuration[output].options:
-                return False
-        else:
-            if output not in target_configuration:
-                return False
+    source_outputs, target_outputs = source_configuration.keys(), target_configuration.keys()
+    for output in source_outputs ^ target_outputs:
+        # Outputs only known to one side must be disabled there
+        configuration = source_configuration.get(output) or target_configuration[output]
+        if "off" not in configuration.options:
+            return False
+    for output in source_outputs & target_outputs:
+        source, target = source_configuration[output], target_configuration[output]
+        source_off = "off" in source.options
+        if source_off != ("off" in target.options):
+            return False
+        if not source_off and source != target:
+            return False
     return True
 
 
 def add_unused_outputs(source_configuration, target_configuration):
     "Add outputs that are missing in target to target, in 'off' state"
+    missing_outputs = source_configuration.keys() - target_configuration.keys()
+    if not missing_outputs:
+        return
+    # Walk the source to add the outputs in its order
     for output_name, output in source_configuration.items():
-        if output_name not in target_configuration:
+        if output_name in missing_outputs:
             target_configuration[output_name] = XrandrOutput(output_name, output.edid, {"off": None})
 
 
 def remove_irrelevant_outputs(source_configuration, target_configuration):
     "Remove outputs from target that ought to be 'off' and already are"
-    for output_name, output in source_configuration.items():
-        if "off" in output.options:
-            if output_name in target_configuration:
-                if "off" in target_configuration[output_name].options:
-                    del target_configuration[output_name]
+    for output_name in source_configuration.keys() & target_configuration.keys():
+        if "off" in source_configuration[output_name].options and "off" in target_configuration[output_name].options:
+            del target_configuration[output_name]
+
+
+def best_mode(output_modes):
+    "Return the largest mode of an output, preferring the preferred one"
+    def key(a):
+        score = int(a["width"]) * int(a["height"])
+        if a["preferred"]:
+            score += 10**6
+        return score
+    # max() returns the first of equally good modes, scan backwards to pick the last one
+    return max(reversed(output_modes), key=key)
 
 
 def generate_virtual_profile(configuration, modes, profile_name):
     "Generate one of the virtual profiles"
-    configuration = copy.deepcopy(configuration)
+    current_configuration = configuration
+    configuration = {name: output.copy_with_options({}) for name, output in current_configuration.items()}
     if profile_name == "common":
         mode_sets = []
         for output, output_modes in modes.items():
@@ -1075,19 +1243,22 @@ def generate_virtual_profile(configuration, modes, profile_name):
                 for mode in output_modes:
                     mode_set.add((mode["width"], mode["height"]))
             mode_sets.append(mode_set)
-        common_resolution = reduce(lambda a, b: a & b, mode_sets[1:], mode_sets[0])
-        common_resolution = sorted(common_resolution, key=lambda a: int(a[0]) * int(a[1]))
+        common_resolution = set.intersection(*mode_sets)
         if common_resolution:
+            largest_resolution = max(common_resolution, key=lambda a: int(a[0]) * int(a[1]))
             for output in configuration:
-                configuration[output].options = {}
                 if output in modes and configuration[output].edid:
                     modes_sorted = sorted(modes[output], key=lambda x: 0 if x["preferred"] else 1)
-                    modes_filtered = [x for x in modes_sorted if (x["width"], x["height"]) == common_resolution[-1]]
+                    modes_filtered = [x for x in modes_sorted if (x["width"], x["height"]) == largest_resolution]
                     mode = modes_filtered[0]
                     configuration[output].options["mode"] = mode['name']
                     configuration[output].options["pos"] = "0x0"
                 else:
                     configuration[output].options["off"] = None
+        else:
+            # No resolution supported by all outputs, keep the current setup
+            configuration = {name: output.copy_with_options(dict(output.options))
+                             for name, output in current_configuration.items()}
     elif profile_name in ("horizontal", "vertical", "horizontal-reverse", "vertical-reverse"):
         shift = 0
         if profile_name.startswith("horizontal"):
@@ -1100,15 +1271,8 @@ def generate_virtual_profile(configuration, modes, profile_name):
         config_iter = reversed(configuration) if "reverse" in profile_name else iter(configuration)
             
         for output in config_iter:
-            configuration[output].options = {}
             if output in modes and configuration[output].edid:
-                def key(a):
-                    score = int(a["width"]) * int(a["height"])
-                    if a["preferred"]:
-                        score += 10**6
-                    return score
-                output_modes = sorted(modes[output], key=key)
-                mode = output_modes[-1]
+                mode = best_mode(modes[output])
                 configuration[output].options["mode"] = mode["name"]
                 configuration[output].options["rate"] = mode["rate"]
                 configuration[output].options["pos"] = pos_specifier % shift
@@ -1120,15 +1284,8 @@ def generate_virtual_profile(configuration, modes, profile_name):
         modes_sorted = sorted(modes_unsorted, key=lambda x: int(x["width"]) * int(x["height"]), reverse=True)
         biggest_resolution = modes_sorted[0]
         for output in configuration:
-            configuration[output].options = {}
             if output in modes and configuration[output].edid:
-                def key(a):
-                    score = int(a["width"]) * int(a["height"])
-                    if a["preferred"]:
-                        score += 10**6
-                    return score
-                output_modes = sorted(modes[output], key=key)
-                mode = output_modes[-1]
+                mode = best_mode(modes[output])
                 configuration[output].options["mode"] = mode["name"]
                 configuration[output].options["rate"] = mode["rate"]
                 configuration[output].options["pos"] = "0x0"
@@ -1141,8 +1298,6 @@ def generate_virtual_profile(configuration, modes, profile_name):
                 configuration[output].options["off"] = None
     elif profile_name == "off":
         for output in configuration:
-            for key in list(configuration[output].options.keys()):
-                del configuration[output].options[key]
             configuration[output].options["off"] = None
     return configuration
 
@@ -1152,7 +1307,7 @@ def print_profile_differences(one, another):
     if one == another:
         return
     print("| Differences between the two profiles:")
-    for output in set(chain.from_iterable((one.keys(), another.keys()))):
+    for output in one.keys() | another.keys():
         if output not in one:
             if "off" not in another[output].options:
                 print("| Output `%s' is missing from the active configuration" % output)
@@ -1181,6 +1336,25 @@ def exit_help():
     sys.exit(0)
 
 
+@functools.lru_cache(maxsize=1)
+def _resolve_profile_path():
+    "Return the directory holding the user's profiles"
+    # Prefer the legacy ~/.autorandr if it already exists
+    profile_path = os.path.expanduser("~/.autorandr")
+    if not os.path.isdir(profile_path):
+        # Elsewise, follow the XDG specification
+        profile_path = os.path.join(os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")), "autorandr")
+    return profile_path
+
+
+@functools.lru_cache(maxsize=1)
+def _xdg_config_dirs():
+    "Return the existing system-wide autorandr directories, highest precedence first"
+    candidates = (os.path.join(config_dir, "autorandr")
+                  for config_dir in os.environ.get("XDG_CONFIG_DIRS", "/etc/xdg").split(":"))
+    return tuple(directory for directory in candidates if os.path.isdir(directory))
+
+
 def exec_scripts(profile_path, script_name, meta_information=None):
     """"Run userscripts
 
@@ -1204,16 +1378,13 @@ def exec_scripts(profile_path, script_name, meta_information=None):
     # If there are multiple candidates, the XDG spec tells to only use the first one.
     ran_scripts = set()
 
-    user_profile_path = os.path.expanduser("~/.autorandr")
-    if not os.path.isdir(user_profile_path):
-        user_profile_path = os.path.join(os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")), "autorandr")
-
     candidate_directories = []
     if profile_path:
         candidate_directories.append(profile_path)
-    candidate_directories.append(user_profile_path)
-    for config_dir in os.environ.get("XDG_CONFIG_DIRS", "/etc/xdg").split(":"):
-        candidate_directories.append(os.path.join(config_dir, "autorandr"))
+    candidate_directories.append(_resolve_profile_path())
+    # Skip directories that do not exist before probing for scripts
+    candidate_directories = [folder for folder in candidate_directories if os.path.isdir(folder)]
+    candidate_directories.extend(_xdg_config_dirs())
 
     for folder in candidate_directories:
         if script_name not in ran_scripts:
@@ -1226,21 +1397,38 @@ def exec_scripts(profile_path, script_name, meta_information=None):
                 ran_scripts.add(script_name)
 
         script_folder = os.path.join(folder, "%s.d" % script_name)
-        if os.access(script_folder, os.R_OK | os.X_OK) and os.path.isdir(script_folder):
-            for file_name in sorted(os.listdir(script_folder)):
-                check_name = "d/%s" % (file_name,)
-                if check_name not in ran_scripts:
-                    script = os.path.join(script_folder, file_name)
-                    if os.access(script, os.X_OK | os.F_OK):
-                        try:
-                            all_ok &= subprocess.call(script, env=env) != 0
-                        except Exception as e:
-                            raise AutorandrException("Failed to execute user command: %s. Error: %s" % (script, str(e)))
-                        ran_scripts.add(check_name)
+        try:
+            file_names = sorted(os.listdir(script_folder))
+        except OSError:
+            file_names = []
+        for file_name in file_names:
+            check_name = "d/%s" % (file_name,)
+            if check_name not in ran_scripts:
+                script = os.path.join(script_folder, file_name)
+                if os.access(script, os.X_OK | os.F_OK):
+                    try:
+                        all_ok &= subprocess.call(script, env=env) != 0
+                    except Exception as e:
+                        raise AutorandrException("Failed to execute user command: %s. Error: %s" % (script, str(e)))
+                    ran_scripts.add(check_name)
 
     return all_ok
 
 
+def read_file_unbuffered(file_name):
+    "Read a file's contents using a plain file descriptor, without Python's buffered I/O layer"
+    fd = os.open(file_name, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+
 def dispatch_call_to_sessions(argv):
     """Invoke autorandr for each open local X11 session with the given options.
 
@@ -1264,8 +1452,25 @@ def dispatch_call_to_sessions(argv):
     autorandr_binary = os.path.abspath(argv[0])
     backup_candidates = {}
 
+    # The sessions are independent of each other, so handle them in parallel,
+    # but do not fork an unbounded number of children on unusual systems
+    max_running_children = 16
+    running_children = set()
+
+    @functools.lru_cache(maxsize=None)
+    def get_pwent(uid):
+        # Most processes belong to the same few users
+        try:
+            return pwd.getpwuid(uid)
+        except KeyError:
+            # User has no pwd entry
+            return None
+
     def fork_child_autorandr(pwent, process_environ):
+        while len(running_children) >= max_running_children:
+            running_children.discard(os.wait()[0])
         print("Running autorandr as %s for display %s" % (pwent.pw_name, process_environ["DISPLAY"]))
+        sys.stdout.flush()
         child_pid = os.fork()
         if child_pid == 0:
             # This will throw an exception if any of the privilege changes fails,
@@ -1287,7 +1492,7 @@ def dispatch_call_to_sessions(argv):
             else:
                 os.execl(autorandr_binary, autorandr_binary, *argv[1:])
             sys.exit(1)
-        os.waitpid(child_pid, 0)
+        running_children.add(child_pid)
 
     # The following line assumes that user accounts start at 1000 and that no
     # one works using the root or another system account. This is rather
@@ -1299,20 +1504,23 @@ def dispatch_call_to_sessions(argv):
     if 'AUTORANDR_UID_MIN' in os.environ:
       uid_min = int(os.environ['AUTORANDR_UID_MIN'])
 
-    for directory in os.listdir("/proc"):
-        directory = os.path.join("/proc/", directory)
-        if not os.path.isdir(directory):
-            continue
+    with os.scandir("/proc") as entries:
+        process_directories = [entry.path for entry in entries
+                               if entry.name.isdigit() and entry.is_dir(follow_symlinks=False)]
+
+    for directory in process_directories:
         environ_file = os.path.join(directory, "environ")
-        if not os.path.isfile(environ_file):
+        try:
+            uid = os.stat(environ_file).st_uid
+        except OSError:
+            # The process has exited in the meantime
             continue
-        uid = os.stat(environ_file).st_uid
 
         if uid < uid_min:
             continue
 
         process_environ = {}
-        for environ_entry in open(environ_file, 'rb').read().split(b"\0"):
+        for environ_entry in read_file_unbuffered(environ_file).split(b"\0"):
             try:
                 environ_entry = environ_entry.decode("ascii")
             except UnicodeDecodeError:
@@ -1350,10 +1558,8 @@ def dispatch_call_to_sessions(argv):
             continue
 
         if display not in X11_displays_done:
-            try:
-                pwent = pwd.getpwuid(uid)
-            except KeyError:
-                # User has no pwd entry
+            pwent = get_pwent(uid)
+            if pwent is None:
                 continue
 
             fork_child_autorandr(pwent, process_environ)
@@ -1363,62 +1569,92 @@ def dispatch_call_to_sessions(argv):
     # XAUTHORITY set.
     for display, process_environ in backup_candidates.items():
         if display not in X11_displays_done:
-            try:
-                pwent = pwd.getpwuid(int(process_environ["UID"]))
-            except KeyError:
-                # User has no pwd entry
+            pwent = get_pwent(int(process_environ["UID"]))
+            if pwent is None:
                 continue
 
             fork_child_autorandr(pwent, process_environ)
             X11_displays_done.add(display)
 
+    for child_pid in running_children:
+        os.waitpid(child_pid, 0)
+
 
 def enabled_monitors(config):
-    monitors = []
-    for monitor in config:
-        if "--off" in config[monitor].option_vector:
+    # An output is passed --off exactly if it has the off option
+    return [monitor for monitor, output in config.items() if "off" not in output.options]
+
+
+_CONFIG_SECTION_RE = re.compile(r"^\[([^\]]+)\]\s*$")
+_CONFIG_OPTION_RE = re.compile(r"^([^#;=:\s\[][^=:]*?)\s*=\s*(.*?)\s*$")
+
+
+def parse_simple_config(file_name):
+    """Return the key/value pairs from the [config] section of an ini file
+
+    Only plain "key = value" lines are understood. Returns None for anything
+    else (continuation lines, interpolation, duplicates, the DEFAULT section,
+    ...), in which case the caller should use configparser instead."""
+    try:
+        with open(file_name) as config_file:
+            lines = config_file.read().splitlines()
+    except OSError:
+        # Like configparser, ignore files that cannot be read
+        return {}
+    section = None
+    seen = set()
+    values = {}
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped[0] in "#;":
             continue
-        monitors.append(monitor)
-    return monitors
+        if line[0].isspace():
+            return None
+        match = _CONFIG_SECTION_RE.match(line)
+        if match:
+            section = match.group(1)
+            if section == "DEFAULT" or section in seen:
+                return None
+            seen.add(section)
+            continue
+        match = _CONFIG_OPTION_RE.match(line)
+        if not match or section is None or "%" in match.group(2):
+            return None
+        key = (section, match.group(1).lower())
+        if key in seen:
+            return None
+        seen.add(key)
+        if section == "config":
+            values[key[1]] = match.group(2)
+    return values
 
 
 def read_config(options, directory):
     """Parse a configuration config.ini from directory and merge it into
     the options dictionary"""
-    config = configparser.ConfigParser()
-    config.read(os.path.join(directory, "settings.ini"))
-    if config.has_section("config"):
-        for key, value in config.items("config"):
-            options.setdefault("--%s" % key, value)
+    config_file = os.path.join(directory, "settings.ini")
+    values = parse_simple_config(config_file)
+    if values is None:
+        # Only imported here, most setups never need it
+        if sys.version_info.major == 2:
+            import ConfigParser as configparser
+        else:
+            import configparser
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        values = dict(config.items("config")) if config.has_section("config") else {}
+    for key, value in values.items():
+        options.setdefault("--%s" % key, value)
+
+
+def _profile_mtime(profile_item):
+    "Sort key for (name, profile) pairs"
+    return profile_item[1]["config-mtime"]
+
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(
-            argv[1:],
-            "s:r:l:d:cfh",
-            [
-                "batch",
-                "dry-run",
-                "change",
-                "cycle",
-                "default=",
-                "save=",
-                "remove=",
-                "load=",
-                "force",
-                "fingerprint",
-                "config",
-                "debug",
-                "skip-options=",
-                "help",
-                "list",
-                "current",
-                "detected",
-                "version",
-                "match-edid",
-                "ignore-lid"
-            ]
-        )
+        opts, args = getopt.getopt(argv[1:], _SHORT_OPTS, _LONG_OPTS)
     except getopt.GetoptError as e:
         print("Failed to parse options: {0}.\n"
               "Use --help to get usage information.".format(str(e)),
@@ -1453,26 +1689,28 @@ def main(argv):
         print("Detected Wayland session '{0}'. Exiting.".format(os.environ["WAYLAND_DISPLAY"]), file=sys.stderr)
         sys.exit(1)
 
+    # --fingerprint and --config only print the current setup, they do not need the stored profiles.
+    # The settings are still read, since they may change how the current setup is detected.
+    load_stored_profiles = "--fingerprint" not in options and "--config" not in options
+
     profiles = {}
     profile_symlinks = {}
     try:
         # Load profiles from each XDG config directory
         # The XDG spec says that earlier entries should take precedence, so reverse the order
-        for directory in reversed(os.environ.get("XDG_CONFIG_DIRS", "/etc/xdg").split(":")):
-            system_profile_path = os.path.join(directory, "autorandr")
-            if os.path.isdir(system_profile_path):
-                profiles.update(load_profiles(system_profile_path))
-                profile_symlinks.update(get_symlinks(system_profile_path))
-                read_config(options, system_profile_path)
-        # For the user's profiles, prefer the legacy ~/.autorandr if it already exists
+        for system_profile_path in reversed(_xdg_config_dirs()):
+            if load_stored_profiles:
+                directory_profiles, directory_symlinks = scan_profiles(system_profile_path)
+                profiles.update(directory_profiles)
+                profile_symlinks.update(directory_symlinks)
+            read_config(options, system_profile_path)
         # profile_path is also used later on to store configurations
-        profile_path = os.path.expanduser("~/.autorandr")
-        if not os.path.isdir(profile_path):
-            # Elsewise, follow the XDG specification
-            profile_path = os.path.join(os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")), "autorandr")
+        profile_path = _resolve_profile_path()
         if os.path.isdir(profile_path):
-            profiles.update(load_profiles(profile_path))
-            profile_symlinks.update(get_symlinks(profile_path))
+            if load_stored_profiles:
+                directory_profiles, directory_symlinks = scan_profiles(profile_path)
+                profiles.update(directory_profiles)
+                profile_symlinks.update(directory_symlinks)
             read_config(options, profile_path)
     except Exception as e:
         raise AutorandrException("Failed to load profiles", e)
@@ -1488,13 +1726,10 @@ def main(argv):
     if "--match-edid" in options:
         update_profiles_edid(profiles, config)
 
-    # Sort by mtime
-    sort_direction = -1
-    if "--cycle" in options:
-        # When cycling through profiles, put the profile least recently used to the top of the list
-        sort_direction = 1
-    profiles = OrderedDict(sorted(profiles.items(), key=lambda x: sort_direction * x[1]["config-mtime"]))
-    profile_symlinks = {k: v for k, v in profile_symlinks.items() if v in (x[0] for x in virtual_profiles) or v in profiles}
+    # Sort by mtime, most recently used first
+    # When cycling through profiles, put the profile least recently used to the top of the list
+    profiles = dict(sorted(profiles.items(), key=_profile_mtime, reverse="--cycle" not in options))
+    profile_symlinks = {k: v for k, v in profile_symlinks.items() if v in _VIRTUAL_NAMES or v in profiles}
 
     if "--fingerprint" in options:
         output_setup(config, sys.stdout)
@@ -1505,7 +1740,7 @@ def main(argv):
         sys.exit(0)
 
     if "--skip-options" in options:
-        skip_options = [y[2:] if y[:2] == "--" else y for y in (x.strip() for x in options["--skip-options"].split(","))]
+        skip_options = frozenset(y[2:] if y[:2] == "--" else y for y in (x.strip() for x in options["--skip-options"].split(",")))
         for profile in profiles.values():
             for output in profile["config"].values():
                 output.set_ignored_options(skip_options)
@@ -1515,7 +1750,7 @@ def main(argv):
     if "-s" in options:
         options["--save"] = options["-s"]
     if "--save" in options:
-        if options["--save"] in (x[0] for x in virtual_profiles):
+        if options["--save"] in _VIRTUAL_NAMES:
             raise AutorandrException("Cannot save current configuration as profile '%s':\n"
                                      "This configuration name is a reserved virtual configuration." % options["--save"])
         error = check_configuration_pre_save(config)
@@ -1541,7 +1776,7 @@ def main(argv):
     if "-r" in options:
         options["--remove"] = options["-r"]
     if "--remove" in options:
-        if options["--remove"] in (x[0] for x in virtual_profiles):
+        if options["--remove"] in _VIRTUAL_NAMES:
             raise AutorandrException("Cannot remove profile '%s':\n"
                                      "This configuration name is a reserved virtual configuration." % options["--remove"])
         if options["--remove"] not in profiles.keys():
@@ -1560,6 +1795,7 @@ def main(argv):
                 if response != "yes":
                     remove = False
             if remove is True:
+                import shutil
                 shutil.rmtree(profile_folder)
                 print("Removed profile '%s'" % options["--remove"])
             else:
@@ -1569,6 +1805,7 @@ def main(argv):
         sys.exit(0)
 
     detected_profiles = find_profiles(config, profiles)
+    detected_rank = {name: index + 1 for index, name in enumerate(detected_profiles)}
     load_profile = False
 
     if "-l" in options:
@@ -1579,46 +1816,53 @@ def main(argv):
         load_profile = args[0]
     else:
         # Find the active profile(s) first, for the block script (See #42)
-        current_profiles = []
-        for profile_name in profiles.keys():
-            configs_are_equal = is_equal_configuration(config, profiles[profile_name]["config"])
-            if configs_are_equal:
-                current_profiles.append(profile_name)
+        profile_is_current = {name: is_equal_configuration(config, profile["config"]) for name, profile in profiles.items()}
+        current_profiles = [name for name, is_current in profile_is_current.items() if is_current]
         block_script_metadata = {
             "CURRENT_PROFILE": "".join(current_profiles[:1]),
             "CURRENT_PROFILES": ":".join(current_profiles)
         }
 
         best_index = 9999
+        profile_folders = {name: os.path.join(profile_path, name) for name in profiles}
+        quiet_listing = any(opt in options for opt in ("--current", "--detected", "--list"))
+        only_current = "--current" in options
+        only_detected = "--detected" in options
+        want_change = "-c" in options or "--change" in options
+        want_cycle = "--cycle" in options
         for profile_name in profiles.keys():
-            if profile_blocked(os.path.join(profile_path, profile_name), block_script_metadata):
-                if not any(opt in options for opt in ("--current", "--detected", "--list")):
+            if profile_name not in detected_rank and (
+                    only_detected or (only_current and not profile_is_current[profile_name])):
+                # Neither printed nor a candidate for loading, no need to run its block script
+                continue
+            if profile_blocked(profile_folders[profile_name], block_script_metadata):
+                if not quiet_listing:
                     print("%s (blocked)" % profile_name)
                 continue
             props = []
-            is_current_profile = profile_name in current_profiles
-            if profile_name in detected_profiles:
+            is_current_profile = profile_is_current[profile_name]
+            if profile_name in detected_rank:
                 if len(detected_profiles) == 1:
                     index = 1
                     props.append("(detected)")
                 else:
-                    index = detected_profiles.index(profile_name) + 1
-                    props.append("(detected) (%d%s match)" % (index, ["st", "nd", "rd"][index - 1] if index < 4 else "th"))
+                    index = detected_rank[profile_name]
+                    props.append("(detected) (%d%s match)" % (index, _ORD_SUFFIX[min(index, 4) - 1]))
                 if index < best_index:
-                    if "-c" in options or "--change" in options or ("--cycle" in options and not is_current_profile):
+                    if want_change or (want_cycle and not is_current_profile):
                         load_profile = profile_name
                         best_index = index
-            elif "--detected" in options:
+            elif only_detected:
                 continue
             if is_current_profile:
                 props.append("(current)")
-            elif "--current" in options:
+            elif only_current:
                 continue
-            if any(opt in options for opt in ("--current", "--detected", "--list")):
+            if quiet_listing:
                 print("%s" % (profile_name, ))
             else:
                 print("%s%s%s" % (profile_name, " " if props else "", " ".join(props)))
-            if not configs_are_equal and "--debug" in options and profile_name in detected_profiles:
+            if not is_current_profile and "--debug" in options and profile_name in detected_rank:
                 print_profile_differences(config, profiles[profile_name]["config"])
 
     if "-d" in options:
@@ -1632,7 +1876,7 @@ def main(argv):
                 print("'%s' symlinked to '%s'" % (load_profile, profile_symlinks[load_profile]))
             load_profile = profile_symlinks[load_profile]
 
-        if load_profile in (x[0] for x in virtual_profiles):
+        if load_profile in _VIRTUAL_NAMES:
             load_config = generate_virtual_profile(config, modes, load_profile)
             scripts_path = os.path.join(profile_path, load_profile)
         else:
@@ -1645,10 +1889,12 @@ def main(argv):
             if "--dry-run" not in options:
                 update_mtime(os.path.join(scripts_path, "config"))
         add_unused_outputs(config, load_config)
-        if load_config == dict(config) and "-f" not in options and "--force" not in options:
+        # Both are plain dicts, so compare them directly and only once
+        config_unchanged = load_config == config
+        if config_unchanged and "-f" not in options and "--force" not in options:
             print("Config already loaded", file=sys.stderr)
             sys.exit(0)
-        if "--debug" in options and load_config != dict(config):
+        if "--debug" in options and not config_unchanged:
             print("Loading profile '%s'" % load_profile)
             print_profile_differences(config, load_config)
 
@@ -1674,6 +1920,7 @@ def main(argv):
         except Exception as e:
             raise AutorandrException("Failed to apply profile '%s'" % load_profile, e, True)
 
+        # Verifying the result takes another xrandr --verbose run, so only do it when debugging
         if "--dry-run" not in options and "--debug" in options:
             new_config, _ = parse_xrandr_output(
                 ignore_lid=ignore_lid,